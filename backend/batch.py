@@ -0,0 +1,124 @@
+# --- START OF FILE batch.py ---
+# Batch mode: generate mood playlists for many inputs in one process.
+#
+#   python batch.py inputs.jsonl -o results.jsonl [--dry-run] [--concurrency 8]
+#
+# Each input line is a JSON object: {"text": "...", "user": "<optional>", "id": "<optional>"}.
+# `user` selects the Spotify token cache `.spotify_cache-<user>` (see spotify_client);
+# inputs without it run as the default user. Library, tags and genre profile are
+# fetched once per user (only if some input misses the mood-result cache), then
+# sentiment + scoring run concurrently for all inputs.
+import argparse
+import asyncio
+import json
+import sys
+import time
+import traceback
+
+from diagnostics import configure_logging, get_logger, instrument, profile_session
+from spotify_client import current_spotify_user
+from spotify_functions import get_current_user_id
+from main import analyze_mood, load_user_state, build_mood_playlist
+
+BATCH_CONCURRENCY = 8 # Max inputs in flight (bounded by Gemini / Spotify rate limits)
+
+log = get_logger("batch")
+
+
+def load_batch_inputs(filepath, text_field="text"):
+    """Reads JSONL inputs, skipping blank/invalid lines. Returns a list of {"id", "user", "text"}."""
+    inputs = []
+    with open(filepath, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line: continue
+            try: item = json.loads(line)
+            except json.JSONDecodeError as e: log.warning(f"Skipping invalid JSON on line {line_no}: {e}"); continue
+            text = item.get(text_field) if isinstance(item, dict) else None
+            if not text: log.warning(f"Skipping line {line_no}: no '{text_field}' field"); continue
+            inputs.append({"id": item.get("id", line_no), "user": item.get("user"), "text": text})
+    return inputs
+
+
+async def run_batch_item(item, get_user_id, get_user_state, semaphore, dry_run):
+    """Generates one playlist; always returns a result record (errors included) with per-stage timings."""
+    timings = {}
+    item_start = time.time()
+    record = {"id": item["id"], "user": item["user"], "text": item["text"]}
+    try:
+        async with semaphore:
+            stage_start = time.time()
+            mood, user_id = await asyncio.gather(analyze_mood(item["text"]), get_user_id())
+            timings["sentiment"] = time.time() - stage_start
+            if "error" in mood: result = mood
+            else: result = await build_mood_playlist(mood, get_user_state, user_id=user_id, dry_run=dry_run, timings=timings)
+    except Exception as e:
+        log.error(f"Batch item {item['id']} failed: {e}\n{traceback.format_exc()}")
+        result = {"error": f"An unexpected error occurred: {str(e)}"}
+    timings["total"] = time.time() - item_start
+    record.update(result)
+    record["timings"] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+    return record
+
+
+def shared_per_user(tasks_by_user, make_coroutine):
+    """Returns an async getter that starts `make_coroutine()` once per Spotify user and shares the task."""
+    def get():
+        user = current_spotify_user.get()
+        if user not in tasks_by_user: tasks_by_user[user] = asyncio.ensure_future(make_coroutine())
+        return tasks_by_user[user]
+    return get
+
+
+async def run_batch(inputs, dry_run=False, concurrency=BATCH_CONCURRENCY):
+    """Runs all inputs, sharing one user lookup and one library/tag/genre fetch per user.
+
+    The library fetch starts lazily, so a batch served entirely from the mood-result cache never
+    touches the library. Returns records in input order.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    get_user_id = shared_per_user({}, lambda: asyncio.to_thread(get_current_user_id))
+    async def load_state_for_current_user():
+        return await load_user_state(await get_user_id()) # User ID is shared too, so no extra lookup
+    get_user_state = shared_per_user({}, lambda: instrument(load_state_for_current_user(), "load_user_state"))
+    item_tasks = []
+    for item in inputs:
+        current_spotify_user.set(item["user"]) # Copied into the task created below
+        item_tasks.append(asyncio.ensure_future(instrument(run_batch_item(item, get_user_id, get_user_state, semaphore, dry_run))))
+    current_spotify_user.set(None)
+    return await asyncio.gather(*item_tasks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate mood playlists for a JSONL file of inputs.")
+    parser.add_argument("input", help="JSONL file, one {\"text\", \"user\"?, \"id\"?} object per line")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results file (default: stdout)")
+    parser.add_argument("--dry-run", action="store_true", help="Score and select tracks but don't create playlists")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Max inputs processed at once")
+    parser.add_argument("--text-field", default="text", help="Input field holding the mood text")
+    args = parser.parse_args(argv)
+    configure_logging(to_stderr=True) # Batch output goes to stdout/files, so stderr is free for diagnostics
+
+    inputs = load_batch_inputs(args.input, args.text_field)
+    if not inputs: log.error("No valid inputs found."); return 1
+
+    batch_start = time.time()
+    with profile_session("batch"): # No-op unless MOODIFY_PROFILE is set
+        records = asyncio.run(run_batch(inputs, dry_run=args.dry_run, concurrency=max(1, args.concurrency)))
+    batch_duration = time.time() - batch_start
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        for record in records: out.write(json.dumps(record) + "\n")
+    finally:
+        if out is not sys.stdout: out.close()
+
+    failed = sum(1 for r in records if "error" in r)
+    summary = f"Processed {len(records)} inputs ({failed} failed) in {batch_duration:.1f}s"
+    if failed: log.warning(summary)
+    else: log.info(summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
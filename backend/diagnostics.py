@@ -0,0 +1,214 @@
+# --- START OF FILE diagnostics.py ---
+# Logging + opt-in profiling for the backend.
+#
+# stdout carries the JSON result and route.ts treats ANY stderr output as a failure,
+# so diagnostics go to a log file by default, never to stdout/stderr.
+#
+# Environment:
+#   MOODIFY_LOG_FILE      log file path (default: moodify.log in the working directory)
+#   MOODIFY_LOG_LEVEL     DEBUG / INFO / WARNING ... (default: WARNING, INFO while profiling)
+#   MOODIFY_PROFILE       off by default; "cprofile", "sample", or "1"/"all" for both
+#   MOODIFY_PROFILE_DIR   where artifacts are written (default: profiles)
+#   MOODIFY_PROFILE_INTERVAL  sampling interval in seconds (default: 0.005)
+#
+# A profiled run writes, per session:
+#   <label>-<ts>.prof           cProfile dump (load with pstats / snakeviz)
+#   <label>-<ts>.pstats.txt     top functions by cumulative time
+#   <label>-<ts>.collapsed      sampled stacks of all threads, for flamegraph.pl / speedscope
+#   <label>-<ts>.tasks.json     per-coroutine wall vs event-loop CPU vs waiting time
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LOGGER_NAME = "moodify"
+DEFAULT_LOG_FILE = "moodify.log"
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_SAMPLE_INTERVAL = 0.005
+PSTATS_TOP_N = 50
+
+_active_session = None # Set while a profile_session is running
+
+
+# --- Logging ---
+def get_logger(name=None):
+    """Returns the backend logger (or a child of it, e.g. get_logger(__name__))."""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+def configure_logging(to_stderr=False):
+    """Sets up the backend logger (log file; done on import so nothing falls through to stderr).
+
+    Only CLI tools that don't speak the route.ts protocol (e.g. batch.py) should pass to_stderr=True.
+    """
+    logger = get_logger()
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not logger.handlers:
+        default_level = "INFO" if get_profile_modes() else "WARNING"
+        level = os.environ.get("MOODIFY_LOG_LEVEL", default_level).upper()
+        logger.setLevel(level if isinstance(logging.getLevelName(level), int) else default_level)
+        file_handler = logging.FileHandler(os.environ.get("MOODIFY_LOG_FILE", DEFAULT_LOG_FILE), delay=True) # File only created on first record
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+        logger.propagate = False
+    if to_stderr and not any(h.get_name() == "stderr" for h in logger.handlers):
+        stderr_handler = logging.StreamHandler(sys.stderr)
+        stderr_handler.set_name("stderr")
+        stderr_handler.setFormatter(formatter)
+        logger.addHandler(stderr_handler)
+    return logger
+
+log = get_logger("diagnostics")
+
+
+# --- Profiling Configuration ---
+def get_profile_modes():
+    """Parses MOODIFY_PROFILE into a set of {"cprofile", "sample"} (empty = profiling off)."""
+    value = os.environ.get("MOODIFY_PROFILE", "").strip().lower()
+    if value in ("", "0", "false", "off", "no"): return set()
+    if value in ("1", "true", "on", "yes", "all"): return {"cprofile", "sample"}
+    return {mode.strip() for mode in value.split(",") if mode.strip() in ("cprofile", "sample")}
+
+
+# --- Stack Sampler (all threads, collapsed-stack output) ---
+class StackSampler(threading.Thread):
+    """Samples every thread's Python stack at a fixed interval and counts collapsed stacks."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(name="moodify-stack-sampler", daemon=True)
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, f"thread-{thread_id}"))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+# --- Coroutine Timing (wall vs CPU vs wait) ---
+class _TimedAwaitable:
+    """Drives a coroutine step by step, timing each step on the event-loop thread.
+
+    CPU = thread CPU spent inside the coroutine's steps; wait = wall time spent suspended
+    (awaiting I/O, threads, locks or other tasks). Nested instrumented coroutines are inclusive.
+    """
+
+    def __init__(self, coro, name, stats):
+        self._coro = coro
+        self._name = name
+        self._stats = stats
+
+    def __await__(self):
+        iterator = self._coro.__await__()
+        start_wall = time.perf_counter()
+        step_wall = step_cpu = 0.0
+        send_value, throw_exc = None, None
+        try:
+            while True:
+                t0, c0 = time.perf_counter(), time.thread_time()
+                try:
+                    yielded = iterator.throw(throw_exc) if throw_exc is not None else iterator.send(send_value)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    step_wall += time.perf_counter() - t0
+                    step_cpu += time.thread_time() - c0
+                try:
+                    send_value, throw_exc = (yield yielded), None
+                except BaseException as exc: # Forward cancellation etc. into the coroutine
+                    send_value, throw_exc = None, exc
+        finally:
+            total_wall = time.perf_counter() - start_wall
+            entry = self._stats[self._name]
+            entry["calls"] += 1
+            entry["wall"] += total_wall
+            entry["cpu"] += step_cpu
+            entry["wait"] += max(0.0, total_wall - step_wall)
+            entry["max_wall"] = max(entry["max_wall"], total_wall)
+
+def instrument(coro, name=None):
+    """Wraps `coro` for per-coroutine timing while a profile session is active; otherwise returns it as-is."""
+    if _active_session is None: return coro
+    return _TimedAwaitable(coro, name or getattr(coro, "__qualname__", repr(coro)), _active_session["task_stats"])
+
+
+# --- Profile Session ---
+@contextmanager
+def profile_session(label):
+    """Profiles the enclosed block when MOODIFY_PROFILE is set and writes artifacts to MOODIFY_PROFILE_DIR."""
+    global _active_session
+    modes = get_profile_modes()
+    if not modes or _active_session is not None:
+        yield
+        return
+
+    session = {"task_stats": defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "wait": 0.0, "max_wall": 0.0})}
+    profiler = cProfile.Profile() if "cprofile" in modes else None
+    sampler = None
+    if "sample" in modes:
+        try: interval = float(os.environ.get("MOODIFY_PROFILE_INTERVAL", DEFAULT_SAMPLE_INTERVAL))
+        except ValueError: interval = DEFAULT_SAMPLE_INTERVAL
+        sampler = StackSampler(interval)
+        sampler.start()
+
+    _active_session = session
+    start_wall = time.perf_counter()
+    if profiler: profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler: profiler.disable()
+        if sampler: sampler.stop()
+        _active_session = None
+        try:
+            _write_profile_artifacts(label, time.perf_counter() - start_wall, profiler, sampler, session["task_stats"])
+        except Exception as e: # Profiling must never break the request
+            log.error(f"Failed to write profile artifacts for {label}: {e}")
+
+def _write_profile_artifacts(label, total_wall, profiler, sampler, task_stats):
+    profile_dir = os.environ.get("MOODIFY_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    os.makedirs(profile_dir, exist_ok=True)
+    base_path = os.path.join(profile_dir, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+
+    if profiler:
+        profiler.dump_stats(f"{base_path}.prof")
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PSTATS_TOP_N)
+        with open(f"{base_path}.pstats.txt", "w") as f: f.write(report.getvalue())
+    if sampler:
+        sampler.write_collapsed(f"{base_path}.collapsed")
+
+    coroutines = {name: {k: round(v, 6) if isinstance(v, float) else v for k, v in stats.items()}
+                  for name, stats in sorted(task_stats.items(), key=lambda x: x[1]["wall"], reverse=True)}
+    with open(f"{base_path}.tasks.json", "w") as f:
+        json.dump({"label": label, "total_wall": round(total_wall, 6), "coroutines": coroutines}, f, indent=2)
+
+    log.info(f"Profile for {label} ({total_wall:.2f}s) written to {base_path}.*")
+
+
+configure_logging()
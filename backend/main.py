@@ -16,12 +16,24 @@ from spotify_functions import (
     get_track_tags_async, # Use async tagging again
     map_emotions_to_tags,
     filter_tracks_by_mood_tag_score, # Use the tag scoring filter
-    get_user_top_artists_genres, # Get genres for recommendations
+    get_user_genre_profile, # Cached genre profile for recommendations
+    get_current_user_id,
     get_recommendations_spotify_search, # Use search recommendations
+    select_playlist_tracks,
     create_mood_playlist,
     TAG_SAMPLE_SIZE,
     RECS_TRACKS_TARGET # Keep needed constants
 )
+from diagnostics import get_logger, instrument, profile_session
+from mood_cache import (
+    mood_cache_key,
+    get_cached_mood_result,
+    store_mood_result,
+    rotate_cached_candidates,
+    record_served_tracks
+)
+
+log = get_logger("main")
 
 # --- Mood Determination (Unchanged) ---
 def get_dominant_mood(emotions):
@@ -52,115 +64,178 @@ def get_dominant_mood(emotions):
     dominant_mood = max(mood_max_scores.items(), key=lambda item: item[1])[0]
     return dominant_mood
 
-# --- Album Image Helper (Unchanged) ---
+# --- Output Formatting (SlimTrack -> API JSON) ---
 def get_album_image(track):
-    try:
-        if 'album_image' in track and track['album_image']: return track['album_image']
-        elif 'album' in track and isinstance(track['album'], dict):
-            images = track['album'].get('images', [])
-            if images and isinstance(images, list) and len(images) > 0:
-                 for img in images:
-                      if isinstance(img, dict) and img.get('url'): return img['url']
-    except Exception: pass
-    return "https://place-hold.it/300x300"
+    return track.album_image or "https://place-hold.it/300x300"
+
+def format_track(track):
+    return {
+        "id": track.id, "name": track.name,
+        "artists": list(track.artists) or ['?'],
+        "album": track.album,
+        "albumImageUrl": get_album_image(track)
+    }
 
-# --- Main Execution Logic (Async Aware for Tagging) ---
-async def async_main():
-    start_time = time.time()
-    result = {}
-    try:
-        user_text = os.environ.get('USER_TEXT') or (" ".join(sys.argv[1:]) if len(sys.argv) > 1 else None)
-        if not user_text: return {"error": "No mood text provided"}
+# --- Mood Analysis (Per Input) ---
+async def analyze_mood(user_text):
+    """Runs sentiment analysis off the event loop. Returns {"emotions", "dominant_mood", "emotion_tags"} or {"error"}."""
+    emotions = await asyncio.to_thread(analyze_sentiment, user_text)
+    if "error" in emotions: return {"error": f"Sentiment analysis failed: {emotions['error']}"}
+    return {
+        "emotions": emotions,
+        "dominant_mood": get_dominant_mood(emotions),
+        "emotion_tags": map_emotions_to_tags(emotions) # Needed for filtering & search query
+    }
 
-        emotions = analyze_sentiment(user_text)
-        if "error" in emotions: return {"error": f"Sentiment analysis failed: {emotions['error']}"}
-        dominant_mood = get_dominant_mood(emotions)
-        emotion_tags = map_emotions_to_tags(emotions) # Needed for filtering & search query
-
-        # --- Fetch User Library Sample & All IDs ---
-        # Get sample for tagging + full list for filtering recs
-        user_library_tracks_sample = get_all_user_tracks_simplified() # Gets shuffled list
-        if not user_library_tracks_sample: return {"error": "Could not fetch tracks from Spotify library."}
-        # Get ALL user track IDs efficiently for filtering recommendations later
-        # We might need a slightly different function for just IDs if get_all_user_tracks_simplified is too slow for full library
-        # For now, assume simplified is fast enough to get all IDs from that subset
-        user_track_ids = {t['id'] for t in user_library_tracks_sample if t.get('id')}
-
-        # --- Async Tagging ---
-        tracks_to_tag = user_library_tracks_sample[:TAG_SAMPLE_SIZE]
-        tagging_start = time.time()
-        tags_by_track_id = await get_track_tags_async(tracks_to_tag)
-        tagging_duration = time.time() - tagging_start
-
-        # Add tags to the sample list
-        tracks_with_tags_list = []
-        for track in tracks_to_tag:
-             track_id = track.get('id')
-             # Only include tracks where we got tags (or tried and failed - empty list)
-             if track_id in tags_by_track_id:
-                 track['tags'] = tags_by_track_id[track_id]
-                 tracks_with_tags_list.append(track)
+# --- Shared User State (Fetched Once, Reused Across Moods) ---
+async def load_user_state(user_id=None):
+    """Fetches library, tags for the tagging sample and the genre profile. Returns None if the library is empty."""
+    # Get sample for tagging + full list for filtering recs
+    user_library_tracks_sample = await asyncio.to_thread(get_all_user_tracks_simplified) # Gets shuffled list
+    if not user_library_tracks_sample: return None
+    user_track_ids = {t.id for t in user_library_tracks_sample if t.id}
+
+    # --- Async Tagging (overlapped with the genre profile fetch) ---
+    tracks_to_tag = user_library_tracks_sample[:TAG_SAMPLE_SIZE]
+    tags_by_track_id, genre_profile = await asyncio.gather(
+        get_track_tags_async(tracks_to_tag),
+        asyncio.to_thread(get_user_genre_profile, user_id)
+    )
+
+    # Add tags to the sample list
+    tracks_with_tags_list = []
+    for track in tracks_to_tag:
+         track_id = track.id
+         # Only include tracks where we got tags (or tried and failed - empty list)
+         if track_id in tags_by_track_id:
+             track.tags = tags_by_track_id[track_id]
+             tracks_with_tags_list.append(track)
+
+    return {
+        "user_track_ids": user_track_ids,
+        "tagged_tracks": tracks_with_tags_list,
+        "genre_profile": genre_profile
+    }
+
+# --- Playlist Generation For One Mood ---
+# One lock per mood-cache key: concurrent requests for the same key (e.g. repeated prompts in a
+# batch) wait for the first one's miss to compute + store, then take turns rotating from the entry
+_mood_key_locks = {}
+
+def get_mood_key_lock(cache_key):
+    if cache_key not in _mood_key_locks: _mood_key_locks[cache_key] = asyncio.Lock()
+    return _mood_key_locks[cache_key]
+
+async def build_mood_playlist(mood, get_user_state, user_id=None, dry_run=False, timings=None):
+    """Builds a playlist for one mood and (unless dry_run) creates it on Spotify.
+
+    Scored candidates and recommendations come from the mood-result cache when `user_id` has a live
+    entry for this mood; otherwise `get_user_state()` is awaited and everything is recomputed.
+    Requests sharing a cache key run one at a time, so only the first one misses.
+    Returns the API result dict; `spotify_url` is None for dry runs. Stage durations go into `timings` if given.
+    """
+    timings = timings if timings is not None else {}
+    if not user_id: return await _build_mood_playlist(mood, get_user_state, None, dry_run, timings)
+    cache_key = mood_cache_key(user_id, mood["dominant_mood"], mood["emotions"])
+    stage_start = time.time()
+    async with get_mood_key_lock(cache_key):
+        timings["cache_key_wait"] = time.time() - stage_start
+        return await _build_mood_playlist(mood, get_user_state, cache_key, dry_run, timings)
+
+async def _build_mood_playlist(mood, get_user_state, cache_key, dry_run, timings):
+    dominant_mood = mood["dominant_mood"]
+    emotion_tags = mood["emotion_tags"]
+    cached_entry = await asyncio.to_thread(get_cached_mood_result, cache_key) if cache_key else None
+
+    if cached_entry:
+        # --- Reuse Cached Candidates (rotated so repeats stay varied) ---
+        mood_matched_user_tracks, recommended_tracks = rotate_cached_candidates(cached_entry)
+    else:
+        stage_start = time.time()
+        user_state = await get_user_state()
+        timings["user_state"] = time.time() - stage_start
+        if not user_state: return {"error": "Could not fetch tracks from Spotify library."}
 
         # --- Filter User Tracks (Using New Tag Score) ---
-        mood_matched_user_tracks = filter_tracks_by_mood_tag_score(
-            tracks_with_tags_list,
+        stage_start = time.time()
+        scored_user_tracks = filter_tracks_by_mood_tag_score(
+            user_state["tagged_tracks"],
             emotion_tags,
             dominant_mood
         )
-
-        # --- Get User Genres for Recs ---
-        user_top_genres = get_user_top_artists_genres(limit=20)
+        mood_matched_user_tracks = [track for _, track in scored_user_tracks]
+        timings["scoring"] = time.time() - stage_start
 
         # --- Get Recommendations (Search Only) ---
-        recommended_tracks = get_recommendations_spotify_search(
+        stage_start = time.time()
+        recommended_tracks = await asyncio.to_thread(
+            get_recommendations_spotify_search,
             emotion_tags,
-            user_top_genres,
+            user_state["genre_profile"],
             dominant_mood,
-            user_track_ids # Pass the set of user track IDs
+            user_state["user_track_ids"], # Pass the set of user track IDs
+            not dry_run # record_history: dry runs must not burn the recommendation pool
         )
-
-        # --- Create Playlist ---
-        if not mood_matched_user_tracks and not recommended_tracks:
-            return {"error": "Couldn't find enough relevant tracks to create a playlist."}
-
-        playlist_info, final_tracks_added = create_mood_playlist(
+        timings["recommendations"] = time.time() - stage_start
+
+        # Dry runs keep their recs out of recommendation_history, so they must not seed the cache either
+        if cache_key and not dry_run and (mood_matched_user_tracks or recommended_tracks):
+            await asyncio.to_thread(store_mood_result, cache_key, scored_user_tracks, recommended_tracks)
+
+    # --- Create Playlist ---
+    if not mood_matched_user_tracks and not recommended_tracks:
+        return {"error": "Couldn't find enough relevant tracks to create a playlist."}
+
+    stage_start = time.time()
+    if dry_run:
+        playlist_info = None
+        final_tracks_added = select_playlist_tracks(mood_matched_user_tracks, recommended_tracks)
+    else:
+        playlist_info, final_tracks_added = await asyncio.to_thread(
+            create_mood_playlist,
             mood_matched_user_tracks, # Pass tag-scored tracks
             recommended_tracks,
             dominant_mood
         )
-
         if not playlist_info: return {"error": "Failed to create Spotify playlist."}
+    timings["playlist"] = time.time() - stage_start
+    if cache_key and not dry_run: # Dry runs serve nothing
+        await asyncio.to_thread(record_served_tracks, cache_key, final_tracks_added or [])
+
+    # --- Format Output ---
+    return {
+        "tracks": [format_track(track) for track in final_tracks_added or []],
+        "spotify_url": playlist_info['external_urls']['spotify'] if playlist_info else None,
+        "dominant_mood": dominant_mood,
+        "cached": bool(cached_entry)
+    }
+
+# --- Main Execution Logic (Async Aware for Tagging) ---
+async def async_main():
+    start_time = time.time()
+    result = {}
+    try:
+        user_text = os.environ.get('USER_TEXT') or (" ".join(sys.argv[1:]) if len(sys.argv) > 1 else None)
+        if not user_text: return {"error": "No mood text provided"}
+
+        # Sentiment and user lookup are independent; the heavy library/tag fetch only runs on a cache miss
+        mood, user_id = await asyncio.gather(
+            instrument(analyze_mood(user_text)),
+            instrument(asyncio.to_thread(get_current_user_id), "get_current_user_id")
+        )
+        if "error" in mood: return mood
 
-        # --- Format Output ---
-        formatted_tracks = []
-        if final_tracks_added:
-            for track in final_tracks_added:
-                 artist_names = track.get('artists', [])
-                 # Ensure artists is list of strings
-                 if artist_names and not isinstance(artist_names[0], str):
-                      artist_names = [a if isinstance(a, str) else (a.get('name', '?') if isinstance(a, dict) else '?') for a in artist_names]
-                 elif not artist_names: artist_names = ['?']
-
-                 formatted_tracks.append({
-                    "id": track.get('id'), "name": track.get('name', '?'),
-                    "artists": artist_names,
-                    "album": track.get('album', {}).get('name', '') if isinstance(track.get('album'), dict) else track.get('album', ''),
-                    "albumImageUrl": get_album_image(track)
-                 })
-
-        result = {
-            "tracks": formatted_tracks,
-            "spotify_url": playlist_info['external_urls']['spotify'],
-            "dominant_mood": dominant_mood
-        }
+        result = await instrument(build_mood_playlist(mood, lambda: instrument(load_user_state(user_id)), user_id=user_id))
 
     except Exception as e:
-        print(f"An unexpected error occurred in async_main: {str(e)}\n{traceback.format_exc()}", file=sys.stderr)
+        log.error(f"An unexpected error occurred in async_main: {str(e)}\n{traceback.format_exc()}")
         result = {"error": f"An unexpected error occurred: {str(e)}"}
 
     total_duration = time.time() - start_time
+    log.info(f"Request finished in {total_duration:.2f}s (mood: {result.get('dominant_mood')}, cached: {result.get('cached')})")
     return result
 
 if __name__ == "__main__":
-    final_result = asyncio.run(async_main())
+    with profile_session("main"): # No-op unless MOODIFY_PROFILE is set
+        final_result = asyncio.run(async_main())
     print(json.dumps(final_result))
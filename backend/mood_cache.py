@@ -0,0 +1,147 @@
+# --- START OF FILE mood_cache.py ---
+# Mood-result cache: reuses scored library candidates + recommendation pools for
+# repeat moods. Keyed on (user, dominant mood, quantized emotion vector) so
+# near-identical inputs share an entry; served counts drive rotation on hits.
+#
+# Sharded on disk as one small file per key under a per-user directory:
+#   mood_result_cache/<user hash>/<key hash>.json    candidates + recs (written once per miss)
+#   mood_result_cache/<user hash>/<key hash>.served  append-only log of served track IDs
+# Only the entry being looked up is ever read, and serving a playlist appends one line
+# instead of rewriting the entry.
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from spotify_functions import SlimTrack, USER_TRACKS_TARGET, RECS_TRACKS_TARGET
+from diagnostics import get_logger
+
+MOOD_RESULT_CACHE_DIR = "mood_result_cache"
+MOOD_RESULT_TTL = 12 * 60 * 60 # Seconds; library/recs go stale after this
+MOOD_RESULT_MAX_ENTRIES_PER_USER = 25 # Oldest entries evicted beyond this
+MOOD_RESULT_MAX_CANDIDATES = USER_TRACKS_TARGET * 4 # Enough for a few rotations
+MOOD_RESULT_MAX_RECOMMENDATIONS = RECS_TRACKS_TARGET * 2
+EMOTION_QUANTIZATION_STEP = 0.2 # Emotion scores are bucketed to this step for the key
+
+log = get_logger("mood_cache")
+
+
+# --- Keying ---
+def emotion_signature(emotions, step=EMOTION_QUANTIZATION_STEP):
+    """Quantizes an emotion vector into a stable string, dropping emotions that round to zero."""
+    buckets = {}
+    for emotion, score in emotions.items():
+        try: bucket = round(float(score) / step)
+        except (TypeError, ValueError): continue
+        if bucket > 0: buckets[emotion] = bucket
+    return "|".join(f"{emotion}:{bucket}" for emotion, bucket in sorted(buckets.items()))
+
+def mood_cache_key(user_id, dominant_mood, emotions):
+    return f"{user_id}|{dominant_mood}|{emotion_signature(emotions)}"
+
+def _short_hash(value):
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:16]
+
+def _entry_paths(key):
+    """Returns (entry path, served-log path) for a key; the user ID is the key's first field."""
+    user_dir = os.path.join(MOOD_RESULT_CACHE_DIR, _short_hash(key.split("|", 1)[0]))
+    base_path = os.path.join(user_dir, _short_hash(key))
+    return f"{base_path}.json", f"{base_path}.served"
+
+
+# --- Compact track rows (only what rotation + output formatting need) ---
+def track_to_row(track):
+    return [track.id, track.name, list(track.artists), track.album, track.album_image]
+
+def track_from_row(row):
+    track_id, name, artists, album, album_image = row
+    return SlimTrack(track_id, name, artists, album, album_image)
+
+
+# --- Lookup / Store ---
+def get_cached_mood_result(key):
+    """Returns the live cache entry for `key` (with a "served" Counter), or None on a miss or expiry."""
+    entry_path, served_path = _entry_paths(key)
+    try:
+        with open(entry_path, "r") as f: entry = json.load(f)
+    except FileNotFoundError: return None
+    except Exception as e: log.warning(f"Mood cache entry {entry_path} unreadable: {e}"); return None
+    if entry.get("key") != key or time.time() - entry.get("created_at", 0) >= MOOD_RESULT_TTL: return None
+
+    served = Counter()
+    try:
+        with open(served_path, "r") as f:
+            for line in f: served.update(line.split())
+    except FileNotFoundError: pass
+    entry["served"] = served
+    return entry
+
+def store_mood_result(key, scored_user_tracks, recommended_tracks):
+    """Caches the top library candidates ((score, track) pairs, best first) and recommendation pool for `key`."""
+    entry_path, served_path = _entry_paths(key)
+    entry = {
+        "key": key,
+        "created_at": time.time(),
+        "candidates": [track_to_row(t) for _, t in scored_user_tracks[:MOOD_RESULT_MAX_CANDIDATES]],
+        "recommendations": [track_to_row(t) for t in recommended_tracks[:MOOD_RESULT_MAX_RECOMMENDATIONS]]
+    }
+    try:
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Rewriting a live entry (e.g. a racing process) keeps its rotation; an expired one starts fresh
+        previous_is_live = get_cached_mood_result(key) is not None
+        # Unique temp file per writer (batch mode stores from several threads), then an atomic
+        # rename, so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f: json.dump(entry, f, separators=(",", ":"))
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except FileNotFoundError: pass
+            raise
+        if not previous_is_live and os.path.exists(served_path): os.remove(served_path) # Fresh pool, fresh rotation
+        _evict_user_entries(os.path.dirname(entry_path))
+    except Exception as e: log.error(f"Error saving mood cache entry {entry_path}: {e}")
+
+def _evict_user_entries(user_dir):
+    """Drops expired entries, then the oldest ones beyond MOOD_RESULT_MAX_ENTRIES_PER_USER."""
+    now = time.time()
+    entries = []
+    for name in os.listdir(user_dir):
+        if not name.endswith(".json"): continue
+        path = os.path.join(user_dir, name)
+        try: entries.append((os.path.getmtime(path), path))
+        except OSError: continue
+    entries.sort(reverse=True) # Newest first
+    for i, (mtime, path) in enumerate(entries):
+        if i >= MOOD_RESULT_MAX_ENTRIES_PER_USER or now - mtime >= MOOD_RESULT_TTL:
+            for stale_path in (path, path[:-len(".json")] + ".served"):
+                try: os.remove(stale_path)
+                except FileNotFoundError: pass
+
+
+# --- Rotation ---
+def rotate_cached_candidates(entry):
+    """Rebuilds (mood_tracks, recommended_tracks) from a cache entry, least-served first.
+
+    Library candidates keep score order within the same served count; recommendations are
+    shuffled within it, so consecutive hits walk through the pool instead of repeating.
+    """
+    served = entry.get("served", {})
+    mood_tracks = [track_from_row(row) for row in entry.get("candidates", [])]
+    mood_tracks.sort(key=lambda t: served.get(t.id, 0)) # Stable: score order preserved per bucket
+    recommended_tracks = [track_from_row(row) for row in entry.get("recommendations", [])]
+    recommended_tracks.sort(key=lambda t: (served.get(t.id, 0), random.random()))
+    return mood_tracks, recommended_tracks
+
+def record_served_tracks(key, tracks):
+    """Appends the IDs that went into a playlist built from `key` to its served log."""
+    entry_path, served_path = _entry_paths(key)
+    track_ids = [t.id for t in tracks if t.id]
+    if not track_ids or not os.path.exists(entry_path): return
+    try:
+        with open(served_path, "a") as f: f.write(" ".join(track_ids) + "\n")
+    except Exception as e: log.error(f"Error recording served tracks for {entry_path}: {e}")
@@ -1,4 +1,5 @@
 import os
+import contextvars
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
@@ -6,8 +7,15 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+# Batch mode sets this per task to act on behalf of another user; None = default token cache
+current_spotify_user = contextvars.ContextVar("current_spotify_user", default=None)
+
+def get_spotify_cache_path(user=None):
+    """Token cache file for a user (each user must have authorized once to create it)"""
+    return f".spotify_cache-{user}" if user else ".spotify_cache"
+
 def get_spotify_client():
-    """Create and return an authenticated Spotify client"""
+    """Create and return an authenticated Spotify client for the current user"""
     scope = (
         "playlist-read-private playlist-read-collaborative "
         "playlist-modify-public playlist-modify-private "
@@ -21,7 +29,7 @@ def get_spotify_client():
         client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
         redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
         scope=scope,
-        cache_path=".spotify_cache"
+        cache_path=get_spotify_cache_path(current_spotify_user.get())
     ))
     
     return sp
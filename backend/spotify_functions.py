@@ -5,6 +5,9 @@ import time
 import random
 import json
 import os
+import sys
+import threading
+import weakref
 from collections import defaultdict
 from datetime import datetime
 import math # For scoring bonuses
@@ -12,10 +15,18 @@ import math # For scoring bonuses
 # Only import client needed
 from spotify_client import get_spotify_client
 from lastfm_client import LastFmClient # Needed again for tagging
+from diagnostics import get_logger, instrument
+
+log = get_logger("spotify_functions")
 
 # --- Constants ---
 TAG_CACHE_FILE = "tag_cache.json"
 RECOMMENDATION_HISTORY_FILE = "recommendation_history.json"
+GENRE_PROFILE_CACHE_FILE = "genre_profile_cache.json"
+GENRE_PROFILE_TTL = 6 * 60 * 60 # Seconds; top artists drift slowly
+TOP_ARTISTS_LIMIT = 50
+# Blend weights for the top-artist time ranges (recent taste counts most)
+TOP_ARTISTS_TIME_RANGE_WEIGHTS = {'short_term': 0.5, 'medium_term': 0.3, 'long_term': 0.2}
 LASTFM_CONCURRENCY = 5 # Limit concurrent Last.fm requests
 TAG_SAMPLE_SIZE = 150 # Increase sample size slightly for tagging
 USER_TRACKS_TARGET = 15
@@ -34,35 +45,72 @@ MOOD_GENRE_MAP = {
 }
 
 
+# --- Compact Track Model ---
+class SlimTrack:
+    """Compact track record used internally instead of full spotipy track dicts.
+
+    Artist, album, image and source strings are interned so tracks sharing an
+    artist or album share one string object across the whole library.
+    """
+    __slots__ = ('id', 'name', 'artists', 'album', 'album_image', 'source', 'popularity', 'tags')
+
+    def __init__(self, id, name, artists=(), album='', album_image='', source='', popularity=0, tags=None):
+        self.id = id
+        self.name = name or 'Unknown Track'
+        self.artists = tuple(sys.intern(a) for a in artists if a)
+        self.album = sys.intern(album) if album else ''
+        self.album_image = sys.intern(album_image) if album_image else ''
+        self.source = sys.intern(source) if source else ''
+        self.popularity = popularity or 0
+        self.tags = tags # None = not tagged yet, [] = tagging failed / no tags
+
+    @property
+    def primary_artist(self):
+        return self.artists[0] if self.artists else None
+
+    @classmethod
+    def from_spotify(cls, track, source=''):
+        """Builds a SlimTrack from a spotipy track dict, dropping everything the pipeline doesn't use."""
+        album = track.get('album') or {}
+        if not isinstance(album, dict): album = {'name': album}
+        image_url = ''
+        for img in album.get('images') or []:
+            if isinstance(img, dict) and img.get('url'): image_url = img['url']; break
+        artist_names = [a.get('name') for a in track.get('artists') or [] if isinstance(a, dict)]
+        return cls(track['id'], track.get('name'), artist_names, album.get('name') or '', image_url, source, track.get('popularity'))
+
+    def __repr__(self):
+        return f"SlimTrack({self.id!r}, {self.name!r}, {self.primary_artist!r})"
+
+
 # --- Cache and History Handling (Unchanged) ---
 def load_json_cache(filepath):
     if os.path.exists(filepath):
         try:
             with open(filepath, "r") as f: return json.load(f)
-        except Exception: print(f"Warning: Cache file {filepath} corrupted."); return {}
+        except Exception: log.warning(f"Cache file {filepath} corrupted."); return {}
     return {}
 
+# Guards the module-level caches below; batch mode updates them from worker threads
+cache_lock = threading.RLock()
+
 def save_json_cache(filepath, data):
     try:
-        with open(filepath, "w") as f: json.dump(data, f, indent=2)
-    except Exception as e: print(f"Error saving cache file {filepath}: {e}")
+        with cache_lock, open(filepath, "w") as f: json.dump(data, f, indent=2)
+    except Exception as e: log.error(f"Error saving cache file {filepath}: {e}")
 
 tag_cache = load_json_cache(TAG_CACHE_FILE)
 recommendation_history = load_json_cache(RECOMMENDATION_HISTORY_FILE)
 if "tracks" not in recommendation_history: recommendation_history = {"tracks": [], "last_updated": None}
+genre_profile_cache = load_json_cache(GENRE_PROFILE_CACHE_FILE)
 
 
 # --- Async Last.fm Tag Fetching (Reinstated & Robust) ---
 async def fetch_tags_for_track(session, semaphore, track_info):
     """Coroutine to fetch tags for a single track using Last.fm."""
-    track_id = track_info.get('id')
-    artist_name = None
-    # Robust artist name extraction
-    artists = track_info.get('artists')
-    if artists and isinstance(artists, list) and artists[0]:
-        if isinstance(artists[0], dict): artist_name = artists[0].get('name')
-        elif isinstance(artists[0], str): artist_name = artists[0] # Should not happen from Spotify direct
-    track_name = track_info.get('name')
+    track_id = track_info.id
+    artist_name = track_info.primary_artist
+    track_name = track_info.name
 
     if not all([track_id, artist_name, track_name]): return track_id, None
 
@@ -73,7 +121,7 @@ async def fetch_tags_for_track(session, semaphore, track_info):
     lastfm = LastFmClient() # Create instance inside coroutine if needed, or pass
 
     async with semaphore:
-        # print(f"Fetching tags: {artist_name} - {track_name}") # Debug
+        log.debug(f"Fetching tags: {artist_name} - {track_name}")
         try:
             # Use the client's methods which now handle rate limiting internally (if implemented there)
             # If not, add asyncio.sleep(LastFmClient.DELAY) here
@@ -91,31 +139,40 @@ async def fetch_tags_for_track(session, semaphore, track_info):
                      tags.update(tag['name'].lower() for tag in artist_tags_resp['toptags']['tag'])
 
         except Exception as e:
-             print(f"Error fetching tags for {artist_name} - {track_name}: {e}")
+             log.error(f"Error fetching tags for {artist_name} - {track_name}: {e}")
              return track_id, None
 
-    final_tags = list(set(t for t in tags if t)) # Clean empty strings and deduplicate
+    final_tags = list(set(sys.intern(t) for t in tags if t)) # Clean empty strings, deduplicate, share tag strings
     if final_tags: tag_cache[cache_key] = final_tags
     return track_id, final_tags
 
+# One Last.fm limiter per event loop, shared by every get_track_tags_async call on it,
+# so LASTFM_CONCURRENCY stays a global cap when batch mode tags several users at once
+_lastfm_semaphores = weakref.WeakKeyDictionary()
+
+def get_lastfm_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _lastfm_semaphores: _lastfm_semaphores[loop] = asyncio.Semaphore(LASTFM_CONCURRENCY)
+    return _lastfm_semaphores[loop]
+
 async def get_track_tags_async(tracks_to_sample):
     """Fetches tags for a list of tracks asynchronously using LastFmClient methods."""
     if not tracks_to_sample: return {}
-    # print(f"Starting async tagging for {len(tracks_to_sample)} tracks...") # Debug
-    semaphore = asyncio.Semaphore(LASTFM_CONCURRENCY)
+    log.debug(f"Starting async tagging for {len(tracks_to_sample)} tracks...")
+    semaphore = get_lastfm_semaphore()
     # No aiohttp session needed if using requests internally in LastFmClient
-    tasks = [fetch_tags_for_track(None, semaphore, track) for track in tracks_to_sample] # Pass None for session
+    tasks = [instrument(fetch_tags_for_track(None, semaphore, track), "fetch_tags_for_track") for track in tracks_to_sample] # Pass None for session
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
     tags_by_track_id = {}
     for i, result in enumerate(results):
         # Use track_info from the original list to ensure correct ID mapping
         track_info = tracks_to_sample[i]
-        track_id_input = track_info.get('id')
+        track_id_input = track_info.id
         if not track_id_input: continue # Skip if input track had no ID
 
         if isinstance(result, Exception):
-            print(f"Task for track ID {track_id_input} failed: {result}")
+            log.error(f"Task for track ID {track_id_input} failed: {result}")
             tags_by_track_id[track_id_input] = [] # Mark as failed (empty list)
         elif result is not None:
             track_id_result, tags = result
@@ -127,17 +184,24 @@ async def get_track_tags_async(tracks_to_sample):
                     tags_by_track_id[track_id_input] = []
             else:
                 # This case should ideally not happen if IDs are handled correctly
-                print(f"Warning: Mismatched ID in tag results. Input: {track_id_input}, Result: {track_id_result}")
+                log.warning(f"Mismatched ID in tag results. Input: {track_id_input}, Result: {track_id_result}")
                 tags_by_track_id[track_id_input] = [] # Mark as failed due to mismatch
         else: # Result was None, treat as failure
              tags_by_track_id[track_id_input] = []
 
     save_json_cache(TAG_CACHE_FILE, tag_cache) # Save updated cache
-    # print(f"Finished tagging. Got results for {len(tags_by_track_id)} tracks.") # Debug
+    log.debug(f"Finished tagging. Got results for {len(tags_by_track_id)} tracks.")
     return tags_by_track_id
 
+# --- Spotify User ---
+def get_current_user_id():
+    """Returns the current user's Spotify ID, or None if it can't be fetched."""
+    try: return get_spotify_client().me()['id']
+    except Exception as e: log.error(f"Error fetching current Spotify user: {e}"); return None
+
 # --- Spotify Library Fetching (Unchanged) ---
 def get_all_user_tracks_simplified():
+    """Fetches saved + owned-playlist tracks as a shuffled list of SlimTrack records."""
     sp = get_spotify_client()
     user_id = sp.me()['id']
     all_tracks = []
@@ -150,9 +214,9 @@ def get_all_user_tracks_simplified():
             for item in results.get('items', []):
                 track = item.get('track')
                 if track and track.get('id') and track['id'] not in all_track_ids:
-                    all_track_ids.add(track['id']); track['source'] = 'Saved'; all_tracks.append(track)
+                    all_track_ids.add(track['id']); all_tracks.append(SlimTrack.from_spotify(track, 'Saved'))
             results = sp.next(results) if results.get('next') else None
-    except Exception as e: print(f"Error fetching saved tracks: {e}")
+    except Exception as e: log.error(f"Error fetching saved tracks: {e}")
 
     try: # Playlists
         playlists = sp.user_playlists(user_id, limit=playlist_limit)
@@ -167,28 +231,76 @@ def get_all_user_tracks_simplified():
                             for item in pl_results.get('items', []):
                                 track = item.get('track')
                                 if track and track.get('id') and track['id'] not in all_track_ids:
-                                    all_track_ids.add(track['id']); track['source'] = playlist_name; all_tracks.append(track)
+                                    all_track_ids.add(track['id']); all_tracks.append(SlimTrack.from_spotify(track, playlist_name))
                             pl_results = sp.next(pl_results) if pl_results.get('next') else None
-                    except Exception as e: print(f"Error fetching items for playlist {playlist_name}: {e}")
-    except Exception as e: print(f"Error fetching user playlists: {e}")
+                    except Exception as e: log.error(f"Error fetching items for playlist {playlist_name}: {e}")
+    except Exception as e: log.error(f"Error fetching user playlists: {e}")
 
     random.shuffle(all_tracks)
     return all_tracks
 
-# --- Spotify Top Artists (For Genre Info) ---
-def get_user_top_artists_genres(limit=20, time_range='short_term'):
-    """Gets genres from user's top artists."""
+# --- Spotify Top Artists (Cached Genre Profile) ---
+def fetch_top_artist_genre_weights(sp, time_range, limit=TOP_ARTISTS_LIMIT):
+    """Returns {genre: weight} for one time range; higher-ranked artists weigh more."""
+    weights = defaultdict(float)
+    results = sp.current_user_top_artists(limit=limit, time_range=time_range)
+    items = results.get('items', []) if results else []
+    for rank, artist in enumerate(items):
+        rank_weight = (len(items) - rank) / len(items)
+        for genre in artist.get('genres', []):
+            weights[genre] += rank_weight
+    return weights
+
+def match_mood_genres(genre_weights):
+    """Precomputes, for every mood in MOOD_GENRE_MAP, the user's best genre per mood genre."""
+    mood_genres = {}
+    for mood, candidate_genres in MOOD_GENRE_MAP.items():
+        matched = []
+        for mood_genre in candidate_genres:
+            # Prefer the user's highest-weighted genre that contains the mood genre (e.g. 'indie pop' for 'pop')
+            containing = [g for g in genre_weights if mood_genre in g]
+            if not containing: continue
+            best_genre = max(containing, key=lambda g: genre_weights[g])
+            if best_genre not in matched: matched.append(best_genre)
+        mood_genres[mood] = matched
+    return mood_genres
+
+def get_user_genre_profile(user_id, force_refresh=False):
+    """Gets the user's blended top-artist genre profile, cached per user for GENRE_PROFILE_TTL seconds.
+
+    A cache hit makes no Spotify calls. With user_id=None the profile is fetched but not cached.
+    Profile: {"fetched_at", "genre_weights": {genre: weight}, "mood_genres": {mood: [user genres]}}
+    """
+    cached = genre_profile_cache.get(user_id) if user_id else None
+    if not force_refresh and cached and time.time() - cached.get('fetched_at', 0) < GENRE_PROFILE_TTL:
+        return cached
+
     sp = get_spotify_client()
-    genres = set()
-    try:
-        results = sp.current_user_top_artists(limit=limit, time_range=time_range)
-        if results and results.get('items'):
-            for artist in results['items']:
-                genres.update(artist.get('genres', []))
-        return list(genres)
-    except Exception as e:
-        print(f"Error fetching user top artists for genres: {e}")
-        return []
+    blended = defaultdict(float)
+    fetched_any = False
+    for time_range, range_weight in TOP_ARTISTS_TIME_RANGE_WEIGHTS.items():
+        try:
+            for genre, weight in fetch_top_artist_genre_weights(sp, time_range).items():
+                blended[genre] += weight * range_weight
+            fetched_any = True
+        except Exception as e:
+            log.error(f"Error fetching user top artists ({time_range}) for genres: {e}")
+
+    if not fetched_any: # Keep serving a stale profile rather than nothing
+        return cached or {"genre_weights": {}, "mood_genres": {}}
+
+    total = sum(blended.values()) or 1.0
+    genre_weights = {g: round(w / total, 6) for g, w in sorted(blended.items(), key=lambda x: x[1], reverse=True)}
+    profile = {
+        "fetched_at": time.time(),
+        "genre_weights": genre_weights,
+        "mood_genres": match_mood_genres(genre_weights)
+    }
+    if user_id:
+        with cache_lock:
+            genre_profile_cache[user_id] = profile
+            save_json_cache(GENRE_PROFILE_CACHE_FILE, genre_profile_cache)
+    return profile
 
 
 # --- Mood Tag Mapping (Unchanged) ---
@@ -222,7 +334,11 @@ def map_emotions_to_tags(emotions):
 
 # --- Filtering Logic (Refined Tag Scoring) ---
 def filter_tracks_by_mood_tag_score(tracks_with_tags_list, mood_tags, dominant_mood_category):
-    """Filters tracks based on tags with improved scoring and negative filtering."""
+    """Filters tracks based on tags with improved scoring and negative filtering.
+
+    Returns (score, track) pairs, best first. Tracks are not modified, since batch mode
+    scores the same shared tracks for several moods concurrently.
+    """
     scored_tracks = []
     negative_tags_map = {
         'happy': {'sad', 'melancholy', 'melancholic', 'depressing', 'heartbreak', 'angry', 'rage', 'somber'},
@@ -239,8 +355,8 @@ def filter_tracks_by_mood_tag_score(tracks_with_tags_list, mood_tags, dominant_m
     mood_tag_weights = {tag: (mood_tags_len - i) / mood_tags_len for i, tag in enumerate(mood_tags)}
 
     for track in tracks_with_tags_list:
-        track_id = track.get('id')
-        track_tags_list = track.get('tags')
+        track_id = track.id
+        track_tags_list = track.tags
         if not track_id or track_tags_list is None: continue # Skip tracks without ID or fetched tags
         track_tags = set(track_tags_list)
         if not track_tags: continue
@@ -274,20 +390,23 @@ def filter_tracks_by_mood_tag_score(tracks_with_tags_list, mood_tags, dominant_m
         if intersecting_negative:
              penalty_factor = 0.85 # Strong penalty
              final_score *= (1.0 - penalty_factor)
-             # print(f"Penalizing {track.get('name')} for {intersecting_negative}. Score: {tag_score:.2f} -> {final_score:.2f}") # Debug
+             log.debug(f"Penalizing {track.name} for {intersecting_negative}. Score: {tag_score:.2f} -> {final_score:.2f}")
 
         # Filter based on final score
         if final_score > 0.05: # Threshold slightly higher due to bonuses
-            track['mood_score'] = final_score
-            scored_tracks.append(track)
+            scored_tracks.append((final_score, track))
 
-    scored_tracks.sort(key=lambda x: x.get('mood_score', 0), reverse=True)
+    scored_tracks.sort(key=lambda x: x[0], reverse=True)
     return scored_tracks
 
 
 # --- Recommendation Logic (Spotify Search Only - Refined Query) ---
-def get_recommendations_spotify_search(mood_tags, user_top_genres, dominant_mood, user_track_ids):
-    """Gets recommendations using Spotify search with enhanced query."""
+def get_recommendations_spotify_search(mood_tags, genre_profile, dominant_mood, user_track_ids, record_history=True):
+    """Gets recommendations using Spotify search with enhanced query.
+
+    record_history=False (dry runs) leaves recommendation_history untouched, so candidates
+    that were never served aren't excluded from future recommendations.
+    """
     sp = get_spotify_client()
     recommended_tracks = []
     processed_rec_ids = set()
@@ -302,29 +421,18 @@ def get_recommendations_spotify_search(mood_tags, user_top_genres, dominant_mood
     # 2. Add Top 1-2 specific mood tags (keywords)
     query_parts.extend(mood_tags[:2])
 
-    # 3. Add 1-2 relevant genres derived from user's top genres
-    relevant_mood_genres = MOOD_GENRE_MAP.get(dominant_mood, [])
+    # 3. Add 1-2 user genres matching the mood (precomputed in the genre profile)
     found_genres = 0
-    if relevant_mood_genres and user_top_genres:
-        user_top_genres_set = set(user_top_genres) # Faster lookups
-        for mood_genre in relevant_mood_genres:
-             # Check if mood_genre exists (partially or fully) in user's genres
-             if mood_genre in user_top_genres_set or any(mood_genre in top_g for top_g in user_top_genres_set):
-                  # Prefer specific genres from user's list if possible
-                  matched_user_genre = mood_genre # Default
-                  for top_g in user_top_genres_set:
-                       if mood_genre in top_g:
-                           matched_user_genre = top_g # Use the more specific user genre
-                           break
-                  if matched_user_genre not in query_parts: # Avoid duplicates
-                      query_parts.append(matched_user_genre)
-                      found_genres += 1
-                      if found_genres >= 2: break # Limit added genres
+    for matched_user_genre in genre_profile.get('mood_genres', {}).get(dominant_mood, []):
+        if matched_user_genre not in query_parts: # Avoid duplicates
+            query_parts.append(matched_user_genre)
+            found_genres += 1
+            if found_genres >= 2: break # Limit added genres
 
     search_query = " ".join(filter(None, query_parts)) # Ensure no empty strings
 
     if not search_query:
-        print("Warning: Could not build a search query for recommendations.")
+        log.warning("Could not build a search query for recommendations.")
         return []
 
     previously_recommended = set(recommendation_history.get("tracks", []))
@@ -333,7 +441,7 @@ def get_recommendations_spotify_search(mood_tags, user_top_genres, dominant_mood
         results = sp.search(q=search_query, type='track', limit=search_limit, market='from_token')
         time.sleep(0.1)
     except Exception as e:
-        print(f"Spotify search failed for query '{search_query}': {e}")
+        log.error(f"Spotify search failed for query '{search_query}': {e}")
         return []
 
     if results and results.get('tracks') and results['tracks'].get('items'):
@@ -353,43 +461,25 @@ def get_recommendations_spotify_search(mood_tags, user_top_genres, dominant_mood
                  continue
 
             # Format track data consistently
-            album_data = track.get('album', {})
-            album_images = album_data.get('images', [])
-            artist_list = track.get('artists', [])
-            rec_track_data = {
-                "id": track_id,
-                "name": track.get('name', 'Unknown Track'),
-                "artists": [a.get('name', 'Unknown Artist') for a in artist_list], # List of names
-                "album": album_data.get('name', ''),
-                "album_image": album_images[0]["url"] if album_images else "",
-                "tags": mood_tags[:2] # Store tags used in search
-            }
+            rec_track_data = SlimTrack.from_spotify(track)
+            rec_track_data.tags = mood_tags[:2] # Store tags used in search
             recommended_tracks.append(rec_track_data)
             processed_rec_ids.add(track_id)
 
     # Update recommendation history
-    recommendation_history["tracks"] = list(previously_recommended.union(processed_rec_ids))
-    recommendation_history["last_updated"] = datetime.now().isoformat()
-    save_json_cache(RECOMMENDATION_HISTORY_FILE, recommendation_history)
+    if record_history:
+        with cache_lock: # Re-read under the lock so concurrent searches don't drop each other's IDs
+            recommendation_history["tracks"] = list(set(recommendation_history.get("tracks", [])).union(processed_rec_ids))
+            recommendation_history["last_updated"] = datetime.now().isoformat()
+            save_json_cache(RECOMMENDATION_HISTORY_FILE, recommendation_history)
 
     random.shuffle(recommended_tracks)
     return recommended_tracks
 
 
-# --- Playlist Creation (Mostly Unchanged logic) ---
-def create_mood_playlist(mood_tracks, recommended_tracks, mood_name):
-    # (Logic is the same as the previous correct version, ensure safety checks)
-    sp = get_spotify_client()
-    user_id = sp.me()['id']
-    date_str = datetime.now().strftime("%Y-%m-%d %H:%M")
-    playlist_name = f"{mood_name.capitalize()} Mood - {date_str}"
-    playlist_description = f"Songs matching your {mood_name} mood, created on {date_str}."
-
-    try:
-        playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=False, description=playlist_description)
-        playlist_id = playlist['id']; playlist_url = playlist['external_urls']['spotify']
-    except Exception as e: print(f"Error creating Spotify playlist: {e}"); return None, None
-
+# --- Playlist Track Selection (No Spotify Calls) ---
+def select_playlist_tracks(mood_tracks, recommended_tracks):
+    """Picks user + recommended tracks with per-artist/album caps, shuffled. Used directly for dry runs."""
     final_tracks_added_objects = []; final_track_ids_added = set()
     artists = defaultdict(int); albums = defaultdict(int)
 
@@ -397,12 +487,10 @@ def create_mood_playlist(mood_tracks, recommended_tracks, mood_name):
     user_added = 0
     for track in mood_tracks:
         if user_added >= USER_TRACKS_TARGET: break
-        track_id = track.get('id')
+        track_id = track.id
         if not track_id or track_id in final_track_ids_added: continue
-        artist_list = track.get('artists', [])
-        primary_artist_name = artist_list[0].get('name') if artist_list and isinstance(artist_list[0], dict) else (artist_list[0] if artist_list and isinstance(artist_list[0], str) else None)
-        album_data = track.get('album', {})
-        album_name = album_data.get('name', '') if isinstance(album_data, dict) else album_data
+        primary_artist_name = track.primary_artist
+        album_name = track.album
 
         if not primary_artist_name: continue
         if artists[primary_artist_name] >= 2 or (album_name and albums[album_name] >= 2): continue
@@ -413,30 +501,45 @@ def create_mood_playlist(mood_tracks, recommended_tracks, mood_name):
 
     # 2. Add Recommended Tracks
     recs_added = 0
-    for track in recommended_tracks: # Assumes list of dicts from search
+    for track in recommended_tracks: # SlimTracks from search
         if user_added + recs_added >= TOTAL_TARGET: break
-        track_id = track.get('id')
+        track_id = track.id
         if not track_id or track_id in final_track_ids_added: continue
-        # Artist names should be strings already from search processing
-        artist_list = track.get('artists', []) # List of strings
-        primary_artist_name = artist_list[0] if artist_list else None
-        album_name = track.get('album', '') # Simple string
+        primary_artist_name = track.primary_artist
+        album_name = track.album
 
         if not primary_artist_name: continue
         if artists[primary_artist_name] >= 2 or (album_name and albums[album_name] >= 2): continue
 
-        # Track structure should be consistent now
         final_tracks_added_objects.append(track); final_track_ids_added.add(track_id); recs_added += 1
         artists[primary_artist_name] += 1;
         if album_name: albums[album_name] += 1
 
     random.shuffle(final_tracks_added_objects)
-    track_uris_to_add = [f"spotify:track:{t['id']}" for t in final_tracks_added_objects if t.get('id')]
+    return final_tracks_added_objects
+
+
+# --- Playlist Creation (Mostly Unchanged logic) ---
+def create_mood_playlist(mood_tracks, recommended_tracks, mood_name):
+    # (Logic is the same as the previous correct version, ensure safety checks)
+    sp = get_spotify_client()
+    user_id = sp.me()['id']
+    date_str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    playlist_name = f"{mood_name.capitalize()} Mood - {date_str}"
+    playlist_description = f"Songs matching your {mood_name} mood, created on {date_str}."
+
+    try:
+        playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=False, description=playlist_description)
+        playlist_id = playlist['id']; playlist_url = playlist['external_urls']['spotify']
+    except Exception as e: log.error(f"Error creating Spotify playlist: {e}"); return None, None
+
+    final_tracks_added_objects = select_playlist_tracks(mood_tracks, recommended_tracks)
+    track_uris_to_add = [f"spotify:track:{t.id}" for t in final_tracks_added_objects if t.id]
 
     if track_uris_to_add:
         try:
             for i in range(0, len(track_uris_to_add), 100):
                 sp.playlist_add_items(playlist_id, track_uris_to_add[i:i+100]); time.sleep(0.1)
-        except Exception as e: print(f"Error adding items to playlist {playlist_id}: {e}"); return playlist, []
-    else: print("No tracks selected after filtering.")
+        except Exception as e: log.error(f"Error adding items to playlist {playlist_id}: {e}"); return playlist, []
+    else: log.warning("No tracks selected after filtering.")
     return playlist, final_tracks_added_objects